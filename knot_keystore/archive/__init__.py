@@ -15,6 +15,7 @@ import logging
 
 from knot_keystore.archive.azure import ArchiveAzure
 from knot_keystore.archive.local import ArchiveLocal
+from knot_keystore.archive.s3 import ArchiveS3
 
 log = logging.getLogger(__name__)
 
@@ -24,7 +25,8 @@ __all__ = ["get_plugins"]
 def get_plugins(name=None):
     """Find archive plugins."""
     log.debug("Trying to find available plugins")
-    builtin = {"local": ArchiveLocal, "azure": ArchiveAzure}
+    builtin = {"local": ArchiveLocal, "azure": ArchiveAzure,
+               "s3": ArchiveS3}
     plugins = builtin
     log.debug(f"Available plugins: {plugins}")
     if name is not None:
@@ -11,14 +11,21 @@
 # the License.
 """knot_keystore.archive.azure module."""
 
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import json
 import logging
 import os
 import tempfile
+import threading
+import time
 
 import adal
 
 from azure.keyvault import KeyVaultClient, KeyVaultAuthentication, KeyId
-from azure.storage.blob import BlockBlobService
+from azure.storage.blob import BlockBlobService, Include
 from azure.storage.common import TokenCredential
 
 from knot_keystore.archive.base import ArchiveBase
@@ -33,9 +40,18 @@ STORAGE_RESOURCE_ID = "https://storage.azure.com"
 class ArchiveAzure(ArchiveBase):
     """Archive knot kasp-db to Azure blob storage."""
 
+    name = "azure"
+    key_cache_size = 64
+    key_cache_ttl = 300
+
     def __init__(self, *args, **kwargs):
         """Initialise a new instance."""
         super().__init__(*args, **kwargs)
+        self.wrapped_keys = {}
+        if self.verify_batch_size is None:
+            self.verify_batch_size = self.verify_workers
+        self.verify_batch_size = max(1, min(self.verify_batch_size,
+                                            self.key_cache_size))
         log.debug("Trying to aquire an azure blob service client")
         try:
             self.blob_service = self.get_blob_service()
@@ -62,7 +78,7 @@ class ArchiveAzure(ArchiveBase):
         token_credential = TokenCredential(token["accessToken"])
         blob_service = BlockBlobService(account_name=self.storage_account_name,
                                         token_credential=token_credential)
-        resolver = KeyResolver(context=self)
+        self.key_resolver = resolver = KeyResolver(context=self)
         blob_service.key_encryption_key = resolver.resolve()
         blob_service.key_resolver_function = resolver.resolve
         blob_service.require_encryption = True
@@ -106,6 +122,7 @@ class ArchiveAzure(ArchiveBase):
                           f"and remote ('{blob_sha256_hash}') sha256 hashes")
                 if archive_sha256_hash == blob_sha256_hash:
                     log.info("Content hashes match: exiting")
+                    self.write_run_metrics(skipped=True)
                     return False
                 log.debug("Trying to take blob snapshot")
                 try:
@@ -116,6 +133,7 @@ class ArchiveAzure(ArchiveBase):
                     raise e
             log.debug(f"Trying to store archive to azure")
             metadata = {"content_sha256_hash": archive_sha256_hash}
+            store_start = time.monotonic()
             try:
                 self.blob_service.create_blob_from_path(self.container_name,
                                                         self.blob_name,
@@ -124,74 +142,257 @@ class ArchiveAzure(ArchiveBase):
             except Exception as e:
                 log.error(f"Failed to create azure blob: {e}")
                 raise e
+            self.write_run_metrics(stored_bytes=os.path.getsize(path),
+                                   store_seconds=time.monotonic() - store_start)  # noqa: E501
         log.info("Encrypted archive written to "
                  f"{self.container_name}/{self.blob_name}")
 
+    def get_stored_hash(self):
+        """Get the hash of the stored blob, used to skip uploads."""
+        return self.get_blob_hash()
+
     def retrieve(self):
         """Retrieve and decrypt archive to the knot storage path."""
         log.debug(f"Trying to retrieve kasp-db archive from azure")
         with Knot(socket=self.knotc_socket) as knot:
             storage_path, kaspdb_dir = knot.kaspdb_path
-        cleartext_path = os.path.join(storage_path, "kasp-db.tar.xz")
-        log.debug(f"Trying to get archive from "
+            cleartext_path = os.path.join(storage_path, self.archive_filename)
+            log.debug(f"Trying to get archive from "
+                      f"{self.container_name}/{self.blob_name}")
+            try:
+                self.blob_service.get_blob_to_path(self.container_name,
+                                                   self.blob_name,
+                                                   cleartext_path)
+            except Exception as e:
+                log.error(f"Failed to retrieve azure blob: {e}")
+                raise e
+            log.info(f"Decrypted archive written to {cleartext_path}")
+            self.restore_cleartext_archive(knot, cleartext_path)
+        return
+
+    def list_generations(self):
+        """List the current blob and its snapshots.
+
+        The wrapped content encryption key of each generation is kept, to be
+        unwrapped when its batch is prepared.
+        """
+        log.debug(f"Trying to list snapshots of "
                   f"{self.container_name}/{self.blob_name}")
         try:
-            self.blob_service.get_blob_to_path(self.container_name,
-                                               self.blob_name, cleartext_path)
+            blobs = [blob for blob in
+                     self.blob_service.list_blobs(self.container_name,
+                                                  prefix=self.blob_name,
+                                                  include=Include(snapshots=True,  # noqa: E501
+                                                                  metadata=True))  # noqa: E501
+                     if blob.name == self.blob_name]
         except Exception as e:
-            log.error(f"Failed to retrieve azure blob: {e}")
+            log.error(f"Failed to list azure blobs: {e}")
             raise e
-        log.info(f"Decrypted archive written to {cleartext_path}")
-        return
+        self.wrapped_keys = {}
+        for blob in blobs:
+            generation = blob.snapshot or "current"
+            try:
+                encryption_data = json.loads(blob.metadata["encryptiondata"])
+                wrapped_key = encryption_data["WrappedContentKey"]
+                self.wrapped_keys[generation] = (wrapped_key["KeyId"],
+                                                 base64.b64decode(wrapped_key["EncryptedKey"]),  # noqa: E501
+                                                 wrapped_key["Algorithm"])
+            except (KeyError, TypeError, ValueError) as e:
+                log.warning(f"Failed to read encryption data for blob "
+                            f"snapshot '{blob.snapshot}': {e}")
+        return [blob.snapshot or "current" for blob in blobs]
+
+    def prepare_generations(self, generations):
+        """Unwrap the content encryption keys for a batch of generations.
+
+        Batches are no larger than the key cache, and are unwrapped just
+        before they are fetched, so keys are not evicted or expired first.
+        """
+        self.key_resolver.prefetch([self.wrapped_keys[generation]
+                                    for generation in generations
+                                    if generation in self.wrapped_keys])
+
+    def fetch_generation(self, generation, tmp_path):
+        """Download and decrypt a blob snapshot into tmp_path."""
+        snapshot = None if generation == "current" else generation
+        cleartext_path = os.path.join(tmp_path, self.archive_filename)
+        log.debug(f"Trying to get archive generation '{generation}' from "
+                  f"{self.container_name}/{self.blob_name}")
+        blob = self.blob_service.get_blob_to_path(self.container_name,
+                                                  self.blob_name,
+                                                  cleartext_path,
+                                                  snapshot=snapshot)
+        sha256_hash = blob.metadata.get("content_sha256_hash")
+        return cleartext_path, sha256_hash
+
+
+class KeyCache(object):
+    """A bounded, time-limited cache of unwrapped content encryption keys.
+
+    Keys are held in mutable buffers, which are overwritten with zeros when
+    they expire or are evicted.
+    """
+
+    def __init__(self, size=64, ttl=300):
+        """Initialise a new instance."""
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(kid, wrapped_cek, algorithm):
+        """Get the cache key for a wrapped CEK."""
+        return (kid, algorithm, hashlib.sha256(wrapped_cek).hexdigest())
+
+    def _evict(self, key):
+        """Remove an entry and overwrite the key material."""
+        expiry, value = self.entries.pop(key)
+        value[:] = bytes(len(value))
+
+    def _expire(self):
+        """Remove expired entries."""
+        now = time.monotonic()
+        for key, (expiry, value) in list(self.entries.items()):
+            if expiry <= now:
+                self._evict(key)
+
+    def __contains__(self, key):
+        """Check whether a CEK is cached, without copying or touching it."""
+        with self.lock:
+            self._expire()
+            return key in self.entries
+
+    def get(self, key):
+        """Get an unwrapped CEK, or None if it is not cached."""
+        with self.lock:
+            self._expire()
+            try:
+                expiry, value = self.entries[key]
+            except KeyError:
+                return None
+            self.entries.move_to_end(key)
+            return bytes(value)
+
+    def put(self, key, cek):
+        """Store an unwrapped CEK, evicting the least recently used."""
+        if self.size <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._evict(key)
+            self.entries[key] = (time.monotonic() + self.ttl, bytearray(cek))
+            while len(self.entries) > self.size:
+                self._evict(next(iter(self.entries)))
+
+    def clear(self):
+        """Remove all entries and overwrite the key material."""
+        with self.lock:
+            for key in list(self.entries):
+                self._evict(key)
 
 
 class KeyResolver(object):
-    """Implementation of the KEK interface."""
+    """Resolve key ids to KEKs stored in Azure Key Vault."""
 
     alg = "RSA-OAEP-256"
 
     def __init__(self, context):
-        """Initialise an instance of KeyWrapper."""
+        """Initialise an instance of KeyResolver."""
         self.context = context
+        self.auth_context = adal.AuthenticationContext(context.auth_endpoint)
         auth_callback = self.get_auth_callback()
         auth = KeyVaultAuthentication(auth_callback)
         self.client = KeyVaultClient(auth)
+        self.cache = KeyCache(size=context.key_cache_size,
+                              ttl=context.key_cache_ttl)
 
     def resolve(self, kid=None):
         """Resolve a key id."""
         if kid is None:
-            self.kid = KeyId(vault=self.context.vault_url,
-                             name=self.context.kek_key_name)
+            kid = KeyId(vault=self.context.vault_url,
+                        name=self.context.kek_key_name)
         else:
-            self.kid = KeyId(uri=kid)
-        return self
+            kid = KeyId(uri=kid)
+        return KeyEncryptionKey(resolver=self, kid=kid)
 
     def get_auth_callback(self):
-        """Get a callback to authenticate with ADAL for key vault access."""
+        """Get a callback to authenticate with ADAL for key vault access.
+
+        The authentication context is reused, so that cached tokens are
+        returned until they expire.
+        """
         def auth_callback(server, resource, scope):
-            ctx = adal.AuthenticationContext(self.context.auth_endpoint)
-            token = ctx.acquire_token_with_client_credentials(resource,
-                                                              self.context.client_id,  # noqa: E501
-                                                              self.context.client_secret)  # noqa: E501
+            token = self.auth_context.acquire_token_with_client_credentials(resource,  # noqa: E501
+                                                                            self.context.client_id,  # noqa: E501
+                                                                            self.context.client_secret)  # noqa: E501
             return token["tokenType"], token["accessToken"]
         return auth_callback
 
+    def prefetch(self, wrapped_keys):
+        """Unwrap a batch of (kid, wrapped CEK, algorithm) into the cache.
+
+        Duplicate and already cached keys are skipped, and the remaining
+        keys are unwrapped concurrently.
+        """
+        pending = {}
+        for kid, wrapped_cek, algorithm in wrapped_keys:
+            kek = self.resolve(kid)
+            key = self.cache.key(kek.get_kid(), wrapped_cek, algorithm)
+            if key not in pending and key not in self.cache:
+                pending[key] = (kek, wrapped_cek, algorithm)
+        if not pending:
+            return
+        log.debug(f"Trying to unwrap {len(pending)} content encryption "
+                  "key(s)")
+
+        def unwrap(args):
+            kek, wrapped_cek, algorithm = args
+            try:
+                kek.unwrap_key(wrapped_cek, algorithm)
+            except Exception as e:
+                log.warning(f"Failed to unwrap content encryption key: {e}")
+        with concurrent.futures.ThreadPoolExecutor(self.context.verify_workers) as pool:  # noqa: E501
+            list(pool.map(unwrap, pending.values()))
+
+
+class KeyEncryptionKey(object):
+    """Implementation of the KEK interface."""
+
+    def __init__(self, resolver, kid):
+        """Initialise an instance of KeyEncryptionKey."""
+        self.resolver = resolver
+        self.kid = kid
+
     def get_kid(self):
         """Get the key ID of the KEK."""
         return self.kid.id
 
     def get_key_wrap_algorithm(self):
         """Get the algorithm used to wrap CEKs."""
-        return self.alg
+        return self.resolver.alg
 
     def wrap_key(self, cek):
-        """Wrap the specified CEK."""
-        resp = self.client.wrap_key(self.kid.vault, self.kid.name,
-                                    self.kid.version, self.alg, cek)
+        """Wrap the specified CEK.
+
+        The KEK id is updated to the version that was used, so that the
+        versioned id is recorded alongside the wrapped CEK.
+        """
+        resp = self.resolver.client.wrap_key(self.kid.vault, self.kid.name,
+                                             self.kid.version,
+                                             self.resolver.alg, cek)
+        self.kid = KeyId(uri=resp.kid)
         return resp.result
 
     def unwrap_key(self, wraped_cek, algorithm):
-        """Unwrap the wraped CEK."""
-        resp = self.client.unwrap_key(self.kid.vault, self.kid.name,
-                                      self.kid.version, algorithm, wraped_cek)
+        """Unwrap the wraped CEK, using the cache where possible."""
+        key = self.resolver.cache.key(self.kid.id, wraped_cek, algorithm)
+        cek = self.resolver.cache.get(key)
+        if cek is not None:
+            log.debug("Found unwrapped content encryption key in cache")
+            return cek
+        resp = self.resolver.client.unwrap_key(self.kid.vault, self.kid.name,
+                                               self.kid.version, algorithm,
+                                               wraped_cek)
+        self.resolver.cache.put(key, resp.result)
         return resp.result
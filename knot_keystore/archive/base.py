@@ -11,70 +11,429 @@
 # the License.
 """knot_keystore.archive.base module."""
 
+import base64
+import concurrent.futures
+import contextlib
 import functools
 import hashlib
+import json
 import logging
 import os
 import shutil
+import struct
+import tarfile
 import tempfile
+import threading
+import time
 
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidSignature
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 from knot_keystore.knot import Knot
 
+try:
+    import lmdb
+except ImportError:  # pragma: no cover
+    lmdb = None
+
 log = logging.getLogger(__name__)
 
+CHUNK_SIZE = 64 * 1024
+FERNET_HEADER_SIZE = 25
+FERNET_HMAC_SIZE = 32
 
-def with_encrypted_archive(func):
-    """Wrap the decorated function with archival and encryption."""
-    @functools.wraps(func)
-    def wrapper(self, *args, **kwargs):
-        log.debug("Generating symetric encryption key")
-        key = Fernet.generate_key()
-        cipher = Fernet(key)
-        log.debug("Creating temp directory")
-        with tempfile.TemporaryDirectory() as tmp_path:
-            log.debug(f"Working in {tmp_path}")
-            cleartext_path, hash = self.get_cleartext_archive(tmp_path)
-            ciphertext_path = f"{cleartext_path}.enc"
-            log.debug("Trying to open cleartext archive for reading")
-            try:
-                with open(cleartext_path, "rb") as cleartext_file:
-                    cleartext = cleartext_file.read()
-            except Exception as e:
-                log.error(f"Failed to read cleartext archive: {e}")
-                raise e
-            log.debug("Trying to encrypt archive")
-            try:
-                ciphertext = cipher.encrypt(cleartext)
-            except Exception as e:
-                log.error(f"Failed to encrypt archive: {e}")
-                raise e
-            log.debug("Trying to open ciphertext archive for writing")
+_metrics_lock = threading.Lock()
+
+
+def sha256_file(path):
+    """Calculate the sha256 hash over the contents of a file."""
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for blk in iter(functools.partial(f.read, CHUNK_SIZE), b""):
+            hash.update(blk)
+    return hash.hexdigest()
+
+
+class HashingWriter(object):
+    """File-like object that hashes everything written through it."""
+
+    def __init__(self, fileobj):
+        """Initialise a new instance."""
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.bytes = 0
+
+    def write(self, data):
+        """Hash and write data."""
+        self.hash.update(data)
+        self.bytes += len(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        """Get the sha256 hash over the data written so far."""
+        return self.hash.hexdigest()
+
+
+class EncryptingWriter(object):
+    """File-like object that writes a fernet token of everything written.
+
+    The token is produced incrementally, so that an archive can be
+    encrypted as it is created without holding it in memory. The token is
+    only complete once close() has been called.
+    """
+
+    def __init__(self, key, fileobj):
+        """Initialise a new instance."""
+        key = base64.urlsafe_b64decode(key)
+        backend = default_backend()
+        iv = os.urandom(16)
+        header = b"\x80" + struct.pack(">Q", int(time.time())) + iv
+        self.fileobj = fileobj
+        self.signer = hmac.HMAC(key[:16], hashes.SHA256(), backend=backend)
+        self.encryptor = Cipher(algorithms.AES(key[16:]), modes.CBC(iv),
+                                backend=backend).encryptor()
+        self.padder = padding.PKCS7(algorithms.AES.block_size).padder()
+        self.pending = b""
+        self.signer.update(header)
+        self._encode(header)
+
+    def __enter__(self):
+        """Enter writer context."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Complete the token, unless an exception was raised."""
+        if exc_type is None:
+            self.close()
+        return None
+
+    def _encode(self, data):
+        """Base64 encode and write data, in multiples of three bytes."""
+        data = self.pending + data
+        aligned = len(data) - len(data) % 3
+        self.fileobj.write(base64.urlsafe_b64encode(data[:aligned]))
+        self.pending = data[aligned:]
+
+    def _encrypt(self, data):
+        """Encrypt, sign and write padded cleartext."""
+        ciphertext = self.encryptor.update(data)
+        self.signer.update(ciphertext)
+        self._encode(ciphertext)
+
+    def write(self, data):
+        """Encrypt and write data."""
+        self._encrypt(self.padder.update(data))
+        return len(data)
+
+    def close(self):
+        """Write the final ciphertext block and token signature."""
+        self._encrypt(self.padder.finalize())
+        ciphertext = self.encryptor.finalize()
+        self.signer.update(ciphertext)
+        self._encode(ciphertext + self.signer.finalize())
+        self.fileobj.write(base64.urlsafe_b64encode(self.pending))
+        self.pending = b""
+
+
+def fingerprint_databases(paths):
+    """Get the total size and a change fingerprint of database directories.
+
+    The fingerprint is a sha256 hash over the name, size and modification
+    time of every file except LMDB lock files, so it can be taken without
+    reading the databases or freezing knot.
+    """
+    size = 0
+    hash = hashlib.sha256()
+    for root_dir, base_dir in sorted(paths):
+        for dir_path, dir_names, file_names in sorted(os.walk(os.path.join(root_dir, base_dir))):  # noqa: E501
+            for name in sorted(file_names):
+                if name == "lock.mdb":
+                    continue
+                st = os.stat(os.path.join(dir_path, name))
+                size += st.st_size
+                rel_path = os.path.relpath(os.path.join(dir_path, name),
+                                           root_dir)
+                hash.update(f"{rel_path}\0{st.st_size}\0"
+                            f"{st.st_mtime_ns}\0".encode())
+    return size, hash.hexdigest()
+
+
+def _median(values):
+    """Get the median of a non-empty list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def fsync_path(path):
+    """Flush a file or directory to stable storage."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_open(path):
+    """Open a temp file next to path, and rename it over path.
+
+    The temp file is created (with mode 0600) in the destination directory,
+    so no extra copy is needed. If the block completes, the file is fsync'd
+    and atomically renamed over path, and the directory is fsync'd. If the
+    block raises, the temp file is removed and path is left untouched.
+    """
+    dir_path, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{name}.", dir=dir_path)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        fsync_path(dir_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextlib.contextmanager
+def atomic_directory(link_path):
+    """Create a fresh directory, and atomically point link_path at it.
+
+    The directory is created (with mode 0700) next to link_path and its
+    path is yielded for the block to fill. If the block completes, its
+    files and the directory are fsync'd, and a symlink to it is renamed
+    over link_path, so readers see either the previous set of files or
+    the new one. The previous directory is then removed. If the block
+    raises, the new directory is removed and link_path is left untouched.
+    """
+    parent, name = os.path.split(os.path.abspath(link_path))
+    tmp_dir = tempfile.mkdtemp(prefix=f".{name}.", dir=parent)
+    tmp_link = f"{tmp_dir}.link"
+    try:
+        yield tmp_dir
+        for entry in os.listdir(tmp_dir):
+            fsync_path(os.path.join(tmp_dir, entry))
+        fsync_path(tmp_dir)
+        try:
+            previous = os.readlink(link_path)
+        except FileNotFoundError:
+            previous = None
+        os.symlink(os.path.basename(tmp_dir), tmp_link)
+        os.replace(tmp_link, link_path)
+        fsync_path(parent)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    finally:
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+    if previous is not None:
+        log.debug(f"Removing previous generation {previous}")
+        shutil.rmtree(os.path.join(parent, previous), ignore_errors=True)
+
+
+def copy_range(src, dst, offset, count):
+    """Copy count bytes from offset in file src to file dst in the kernel.
+
+    Uses copy_file_range where available, falling back to sendfile.
+    """
+    copy = getattr(os, "copy_file_range", None)
+    while count > 0:
+        if copy is not None:
             try:
-                with open(ciphertext_path, "wb") as ciphertext_file:
-                    ciphertext_file.write(ciphertext)
-            except Exception as e:
-                log.error(f"Failed to write cyphertext archive: {e}")
-                raise e
-            log.debug("Trying to call wrapped method")
+                copied = copy(src.fileno(), dst.fileno(), count, offset)
+            except OSError as e:
+                log.debug(f"copy_file_range failed, using sendfile: {e}")
+                copy = None
+                continue
+        else:
+            copied = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+        if copied == 0:
+            raise EOFError(f"Unexpected end of file at offset {offset}")
+        offset += copied
+        count -= copied
+
+
+def _b64decode_aligned(encoded):
+    """Decode the 4-character aligned part of url-safe base64 data.
+
+    Returns the decoded bytes and the remaining undecoded characters.
+    """
+    aligned = len(encoded) - len(encoded) % 4
+    try:
+        return base64.urlsafe_b64decode(encoded[:aligned]), encoded[aligned:]
+    except ValueError:
+        raise InvalidToken
+
+
+def _fernet_decryptor(key, header, signer):
+    """Check a fernet token header and get a decryptor for the token body."""
+    if header[0] != 0x80:
+        raise InvalidToken
+    signer.update(header)
+    iv = header[9:FERNET_HEADER_SIZE]
+    return Cipher(algorithms.AES(key[16:]), modes.CBC(iv),
+                  backend=default_backend()).decryptor()
+
+
+def decrypt_stream(key, src, dst, chunk_size=CHUNK_SIZE):
+    """Authenticate and decrypt a fernet token read from src into dst.
+
+    The token is processed in chunks, so memory use does not depend on the
+    size of the archive. Cleartext is written to dst before the token
+    signature has been checked: if an exception is raised, the contents of
+    dst must be discarded.
+    """
+    key = base64.urlsafe_b64decode(key)
+    signer = hmac.HMAC(key[:16], hashes.SHA256(), backend=default_backend())
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    decryptor = None
+    encoded = b""
+    data = b""
+    for blk in iter(functools.partial(src.read, chunk_size), b""):
+        decoded, encoded = _b64decode_aligned(encoded + blk)
+        data += decoded
+        if decryptor is None:
+            if len(data) < FERNET_HEADER_SIZE:
+                continue
+            decryptor = _fernet_decryptor(key, data[:FERNET_HEADER_SIZE],
+                                          signer)
+            data = data[FERNET_HEADER_SIZE:]
+        body = data[:-FERNET_HMAC_SIZE]
+        data = data[-FERNET_HMAC_SIZE:]
+        signer.update(body)
+        dst.write(unpadder.update(decryptor.update(body)))
+    if encoded or decryptor is None or len(data) != FERNET_HMAC_SIZE:
+        raise InvalidToken
+    try:
+        signer.verify(data)
+    except InvalidSignature:
+        raise InvalidToken
+    try:
+        dst.write(unpadder.update(decryptor.finalize()))
+        dst.write(unpadder.finalize())
+    except ValueError:
+        raise InvalidToken
+
+
+def _check_members(tar, databases, prefix=""):
+    """Read through the members of an archive, including nested archives."""
+    members = 0
+    for member in tar:
+        members += 1
+        if member.name.startswith("/") or ".." in member.name.split("/"):
+            raise ValueError(f"Unsafe archive member name: {member.name}")
+        if not member.isfile():
+            continue
+        f = tar.extractfile(member)
+        if member.name.endswith(".tar.xz"):
+            log.debug(f"Checking nested archive {member.name}")
+            inner_prefix = prefix + member.name[:-len(".tar.xz")] + "/"
+            with tarfile.open(fileobj=f, mode="r|xz") as inner:
+                members += _check_members(inner, databases, inner_prefix)
+            continue
+        for _ in iter(functools.partial(f.read, CHUNK_SIZE), b""):
+            pass
+        if os.path.basename(member.name) == "data.mdb":
+            databases.append(prefix + os.path.dirname(member.name))
+    return members
+
+
+def _extract_members(path, dest):
+    """Extract an archive to dest, unpacking nested archives in place."""
+    with tarfile.open(path, mode="r:*") as tar:
+        names = [m.name for m in tar.getmembers() if m.isfile()]
+        tar.extractall(dest)
+    for name in names:
+        if name.endswith(".tar.xz"):
+            inner_path = os.path.join(dest, name)
+            _extract_members(inner_path, inner_path[:-len(".tar.xz")])
+
+
+def verify_cleartext_archive(path, sha256_hash=None, check_lmdb=False):
+    """Check the hash, tar structure and optionally the LMDB in an archive."""
+    log.debug(f"Verifying cleartext archive {path}")
+    if sha256_hash is not None:
+        log.debug("Checking sha256 hash over archive contents")
+        actual_hash = sha256_file(path)
+        if actual_hash != sha256_hash:
+            raise ValueError(f"Hash mismatch: expected '{sha256_hash}', "
+                             f"got '{actual_hash}'")
+    log.debug("Checking archive structure")
+    databases = []
+    with tarfile.open(path, mode="r|*") as tar:
+        members = _check_members(tar, databases)
+    if not databases:
+        raise ValueError("No LMDB database found in archive")
+    log.debug(f"Found databases in archive: {databases}")
+    if check_lmdb:
+        verify_lmdb(path, databases)
+    return {"bytes": os.path.getsize(path), "members": members,
+            "databases": databases}
+
+
+def verify_lmdb(path, databases):
+    """Check that the LMDB databases inside an archive can be opened."""
+    if lmdb is None:
+        raise RuntimeError("The 'lmdb' package is required to check "
+                           "LMDB databases")
+    with tempfile.TemporaryDirectory() as tmp_path:
+        log.debug(f"Extracting archive to {tmp_path}")
+        _extract_members(path, tmp_path)
+        for database in databases:
+            log.debug(f"Trying to open LMDB database {database}")
+            env = lmdb.open(os.path.join(tmp_path, database),
+                            readonly=True, lock=False)
             try:
-                return func(self, *args, **kwargs,
-                            ciphertext_path=ciphertext_path,
-                            key=key)
-            except Exception as e:
-                log.error(f"Error during call to wrapped method: {e}")
-                raise e
-    return wrapper
+                with env.begin() as txn:
+                    entries = txn.stat()["entries"]
+            finally:
+                env.close()
+            log.debug(f"Database {database} contains {entries} entries")
+
+
+def make_xztar(base_name, root_dir, base_dir):
+    """Create an xz-compressed tar archive of root_dir/base_dir.
+
+    Unlike shutil.make_archive, this does not change the working directory,
+    so it is safe to call from several threads at once.
+    """
+    path = f"{base_name}.tar.xz"
+    with tarfile.open(path, mode="w:xz") as tar:
+        tar.add(os.path.join(root_dir, base_dir), arcname=base_dir)
+    return path
+
+
+def _reset_mtime(tarinfo):
+    """Clear the modification time of a tar member."""
+    tarinfo.mtime = 0
+    return tarinfo
 
 
 class ArchiveBase(object):
     """Base class for archive plugins."""
 
+    name = None
+    all_databases = False
+    archive_workers = 4
+    metrics_path = None
+    calibration_runs = 20
+    verify_workers = 4
+    verify_batch_size = None
+    verify_lmdb = False
+
     def __init__(self, knotc_socket=None, config=None, *args, **kwargs):
         """Initialise a new instance."""
         log.debug(f"Initialising archive plugin instance {self}")
         self._knotc_socket = knotc_socket
+        self.run_metrics = {}
         if config is not None:
             for k, v in config.items():
                 setattr(self, k, v)
@@ -84,7 +443,21 @@ class ArchiveBase(object):
         """Get knotc_socket property."""
         return self._knotc_socket
 
-    def exec(self, ciphertext_path=None, key=None):  # pragma: no cover
+    @property
+    def archive_name(self):
+        """Get the base name of the archive."""
+        if self.all_databases:
+            return "knot-db"
+        return "kasp-db"
+
+    @property
+    def archive_filename(self):
+        """Get the file name of the cleartext archive."""
+        if self.all_databases:
+            return f"{self.archive_name}.tar"
+        return f"{self.archive_name}.tar.xz"
+
+    def exec(self):  # pragma: no cover
         """Execute archival proceedure, overide in child classes."""
         raise NotImplementedError
 
@@ -92,30 +465,313 @@ class ArchiveBase(object):
         """Retrieve and decrypt archive to the knot storage path."""
         raise NotImplementedError
 
+    def list_generations(self):  # pragma: no cover
+        """List stored archive generations, overide in child classes."""
+        raise NotImplementedError
+
+    def fetch_generation(self, generation, tmp_path):  # pragma: no cover
+        """Fetch and decrypt a stored archive, overide in child classes.
+
+        Returns the path to the cleartext archive in tmp_path, and the
+        recorded sha256 hash of its contents (or None if none was recorded).
+        """
+        raise NotImplementedError
+
+    def prepare_generations(self, generations):
+        """Prepare a batch of archive generations, before they are fetched."""
+        pass
+
+    def verify(self):
+        """Verify every stored archive generation without restoring it.
+
+        Generations are prepared and verified in batches of
+        verify_batch_size, or all at once if it is not set.
+        """
+        log.debug("Trying to list stored archive generations")
+        generations = list(self.list_generations())
+        if not generations:
+            e = RuntimeError("No stored archive generations found")
+            log.error(e)
+            raise e
+        batch_size = self.verify_batch_size or max(len(generations), 1)
+        log.info(f"Verifying {len(generations)} archive generation(s) "
+                 f"using {self.verify_workers} worker(s)")
+        results = []
+        with concurrent.futures.ThreadPoolExecutor(self.verify_workers) as pool:  # noqa: E501
+            for i in range(0, len(generations), batch_size):
+                batch = generations[i:i + batch_size]
+                self.prepare_generations(batch)
+                results.extend(pool.map(self.verify_generation, batch))
+        failed = [r for r in results if r["status"] != "ok"]
+        if failed:
+            e = RuntimeError(f"{len(failed)} of {len(results)} archive "
+                             "generation(s) failed verification")
+            log.error(e)
+            raise e
+        log.info(f"All {len(results)} archive generation(s) verified")
+        return results
+
+    def verify_generation(self, generation):
+        """Verify a single stored archive generation."""
+        log.debug(f"Trying to verify archive generation '{generation}'")
+        result = {"operation": "verify", "plugin": self.name,
+                  "generation": generation}
+        start = time.monotonic()
+        with tempfile.TemporaryDirectory() as tmp_path:
+            try:
+                path, sha256_hash = self.fetch_generation(generation,
+                                                          tmp_path)
+                if sha256_hash is None:
+                    log.warning(f"Archive generation '{generation}' has no "
+                                "recorded sha256 hash")
+                result.update(verify_cleartext_archive(path, sha256_hash,
+                                                       self.verify_lmdb))
+                result["status"] = "ok"
+            except Exception as e:
+                log.error(f"Failed to verify archive generation "
+                          f"'{generation}': {e}")
+                result.update(status="failed", error=str(e))
+        result["seconds"] = round(time.monotonic() - start, 3)
+        log.info(f"Verified archive generation '{generation}': "
+                 f"status={result['status']} "
+                 f"bytes={result.get('bytes', 0)} "
+                 f"seconds={result['seconds']}")
+        self.write_metrics(result)
+        return result
+
+    def write_metrics(self, record):
+        """Append a metrics record to the configured metrics file."""
+        if self.metrics_path is None:
+            return
+        record = dict(record, timestamp=time.time())
+        log.debug(f"Writing metrics record to {self.metrics_path}")
+        try:
+            with _metrics_lock, open(self.metrics_path, "a") as f:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+        except Exception as e:
+            log.warning(f"Failed to write metrics record: {e}")
+
     def get_cleartext_archive(self, tmp_path):
-        """Create an archive of the knot kasp-db."""
-        log.debug("Preparing to create temporary kasp-db archive")
-        base_name = os.path.join(tmp_path, "kasp-db")
+        """Create a cleartext archive file in tmp_path."""
+        path = os.path.join(tmp_path, self.archive_filename)
+        log.debug(f"Trying to create temporary archive {path}")
+        with open(path, "wb") as f:
+            hash = self.write_cleartext_archive(f, tmp_path)
+        log.debug(f"Created temporary archive: {path}")
+        return path, hash
+
+    def get_database_paths(self, knot):
+        """Get the (root_dir, base_dir) of each database to be archived."""
+        if not self.all_databases:
+            return {"kasp-db": knot.kaspdb_path}
+        databases = {}
+        for name, (root_dir, base_dir) in knot.database_paths.items():
+            if os.path.isdir(os.path.join(root_dir, base_dir)):
+                databases[name] = (root_dir, base_dir)
+            else:
+                log.info(f"No {name} found at "
+                         f"{os.path.join(root_dir, base_dir)}: skipping")
+        return databases
+
+    def write_cleartext_archive(self, fileobj, tmp_path):
+        """Write an archive of the knot kasp-db to fileobj.
+
+        Returns the sha256 hash over the archive contents. The sizes,
+        fingerprint and freeze duration are recorded in run_metrics.
+        """
+        writer = HashingWriter(fileobj)
         with Knot(socket=self.knotc_socket) as knot:
-            storage_path, kaspdb_dir = knot.kaspdb_path
+            databases = self.get_database_paths(knot)
+            freeze_start = time.monotonic()
             with knot.freeze():
-                log.debug("Trying to create temporary kasp-db archive")
-                try:
-                    path = shutil.make_archive(base_name=base_name,
-                                               format="xztar",
-                                               root_dir=storage_path,
-                                               base_dir=kaspdb_dir)
-                except Exception as e:
-                    log.error(f"Failed to create temp kasp-db archive: {e}")
-                    raise e
-                log.debug(f"Created temporary archive: {path}")
-                log.debug("Calculating sha256 hash over archive contents")
-                try:
-                    hash = hashlib.sha256()
-                    with open(path, "rb") as f:
-                        for blk in iter(functools.partial(f.read, 4096), b""):
-                            hash.update(blk)
-                except Exception as e:
-                    log.error(f"Failed to calculate hash over {path}: {e}")
-                    raise e
-        return path, hash.hexdigest()
+                start = time.monotonic()
+                source_bytes, fingerprint = fingerprint_databases(databases.values())  # noqa: E501
+                if self.all_databases:
+                    self.write_cleartext_bundle(writer, tmp_path, databases)
+                else:
+                    log.debug("Trying to create kasp-db archive")
+                    root_dir, base_dir = databases["kasp-db"]
+                    try:
+                        with tarfile.open(fileobj=writer, mode="w|xz") as tar:
+                            tar.add(os.path.join(root_dir, base_dir),
+                                    arcname=base_dir)
+                    except Exception as e:
+                        log.error(f"Failed to create kasp-db archive: {e}")
+                        raise e
+                archive_seconds = time.monotonic() - start
+            freeze_seconds = time.monotonic() - freeze_start
+        self.run_metrics = {"source_bytes": source_bytes,
+                            "fingerprint": fingerprint,
+                            "archive_bytes": writer.bytes,
+                            "archive_seconds": round(archive_seconds, 3),
+                            "freeze_seconds": round(freeze_seconds, 3),
+                            "sha256_hash": writer.hexdigest()}
+        return writer.hexdigest()
+
+    def write_cleartext_bundle(self, fileobj, tmp_path, databases):
+        """Write a bundle of archives of the given databases to fileobj.
+
+        Each database is compressed into tmp_path in its own worker thread.
+        Member modification times are cleared, so that the bundle hash only
+        changes when the databases do.
+        """
+        log.debug(f"Trying to archive databases: {list(databases)}")
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.archive_workers) as pool:  # noqa: E501
+                futures = {name: pool.submit(make_xztar,
+                                             os.path.join(tmp_path, name),
+                                             root_dir, base_dir)
+                           for name, (root_dir, base_dir)
+                           in databases.items()}
+                archives = {name: future.result()
+                            for name, future in futures.items()}
+        except Exception as e:
+            log.error(f"Failed to create temp database archives: {e}")
+            raise e
+        log.debug("Trying to bundle database archives")
+        try:
+            with tarfile.open(fileobj=fileobj, mode="w|") as bundle:
+                for archive in archives.values():
+                    bundle.add(archive, arcname=os.path.basename(archive),
+                               filter=_reset_mtime)
+        except Exception as e:
+            log.error(f"Failed to create database bundle: {e}")
+            raise e
+
+    def write_run_metrics(self, stored_bytes=None, store_seconds=None,
+                          skipped=False):
+        """Record metrics for an archival run, for use in planning."""
+        record = dict(self.run_metrics, operation="exec", plugin=self.name,
+                      all_databases=self.all_databases,
+                      stored_bytes=stored_bytes, skipped=skipped,
+                      store_seconds=(None if store_seconds is None
+                                     else round(store_seconds, 3)))
+        log.info(f"Archival run: freeze_seconds="
+                 f"{record.get('freeze_seconds')} "
+                 f"archive_bytes={record.get('archive_bytes')} "
+                 f"stored_bytes={stored_bytes} skipped={skipped}")
+        self.write_metrics(record)
+
+    def read_metrics(self, operation):
+        """Read this plugin's most recent metrics records for an operation."""
+        if self.metrics_path is None:
+            return []
+        log.debug(f"Trying to read metrics from {self.metrics_path}")
+        records = []
+        try:
+            with open(self.metrics_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("operation") == operation and \
+                            record.get("plugin") == self.name and \
+                            record.get("all_databases", False) == self.all_databases:  # noqa: E501
+                        records.append(record)
+        except FileNotFoundError:
+            log.debug("No metrics file found")
+        return records[-self.calibration_runs:]
+
+    def get_stored_hash(self):
+        """Get the hash of the stored archive, if used to skip uploads."""
+        return None
+
+    def plan(self):
+        """Predict the cost of an archival run without freezing knot."""
+        log.debug("Trying to plan archival run")
+        with Knot(socket=self.knotc_socket) as knot:
+            databases = self.get_database_paths(knot)
+        source_bytes, fingerprint = fingerprint_databases(databases.values())
+        history = self.read_metrics("exec")
+        plan = {"plugin": self.name,
+                "databases": {name: os.path.join(*path)
+                              for name, path in databases.items()},
+                "source_bytes": source_bytes,
+                "fingerprint": fingerprint,
+                "calibration_runs": len(history),
+                "changed": None,
+                "dedup_skip": None,
+                "predicted": None}
+        if not history:
+            log.warning("No previous runs found in metrics: "
+                        "unable to predict costs")
+            return plan
+        last = history[-1]
+        plan["changed"] = last.get("fingerprint") != fingerprint
+        stored_hash = self.get_stored_hash()
+        if stored_hash is not None:
+            plan["dedup_skip"] = (not plan["changed"] and
+                                  last.get("sha256_hash") == stored_hash)
+
+        def ratio(numerator, denominator):
+            values = [r[numerator] / r[denominator] for r in history
+                      if r.get(numerator) and r.get(denominator)]
+            return _median(values) if values else None
+        compression = ratio("archive_bytes", "source_bytes")
+        expansion = ratio("stored_bytes", "archive_bytes")
+        archive_rate = ratio("source_bytes", "archive_seconds")
+        store_rate = ratio("stored_bytes", "store_seconds")
+        overheads = [r["freeze_seconds"] - r["archive_seconds"]
+                     for r in history
+                     if r.get("freeze_seconds") is not None and
+                     r.get("archive_seconds") is not None]
+        predicted = {"archive_seconds": None, "freeze_seconds": None,
+                     "archive_bytes": None, "stored_bytes": None,
+                     "store_seconds": None}
+        if archive_rate:
+            predicted["archive_seconds"] = round(source_bytes / archive_rate,
+                                                 3)
+            if overheads:
+                predicted["freeze_seconds"] = round(predicted["archive_seconds"] + _median(overheads), 3)  # noqa: E501
+        if compression:
+            predicted["archive_bytes"] = int(source_bytes * compression)
+            if expansion:
+                predicted["stored_bytes"] = int(predicted["archive_bytes"] *
+                                                expansion)
+                if store_rate:
+                    predicted["store_seconds"] = round(predicted["stored_bytes"] / store_rate, 3)  # noqa: E501
+        if plan["dedup_skip"]:
+            predicted["stored_bytes"] = 0
+            predicted["store_seconds"] = 0
+        plan["predicted"] = predicted
+        log.info(f"Planned archival run: changed={plan['changed']} "
+                 f"dedup_skip={plan['dedup_skip']} "
+                 f"freeze_seconds={predicted['freeze_seconds']}")
+        return plan
+
+    def restore_cleartext_archive(self, knot, path):
+        """Place retrieved cleartext archives ready to restore.
+
+        A single kasp-db archive is left where it is. A database bundle is
+        unpacked, and each database archive is placed next to the directory
+        it should be restored to.
+        """
+        if not self.all_databases:
+            return [path]
+        database_paths = knot.database_paths
+        log.debug(f"Trying to unpack database bundle {path}")
+        restored = []
+        try:
+            with tarfile.open(path, mode="r") as bundle, \
+                    open(path, "rb") as src:
+                for member in bundle.getmembers():
+                    name = member.name[:-len(".tar.xz")]
+                    if name not in database_paths:
+                        log.warning(f"Unknown database archive "
+                                    f"{member.name} in bundle: skipping")
+                        continue
+                    root_dir, base_dir = database_paths[name]
+                    archive_path = os.path.join(root_dir, member.name)
+                    log.debug(f"Trying to write {name} archive to "
+                              f"{archive_path}")
+                    with atomic_open(archive_path) as dst:
+                        copy_range(src, dst, member.offset_data, member.size)
+                    restored.append(archive_path)
+        except Exception as e:
+            log.error(f"Failed to unpack database bundle {path}: {e}")
+            raise e
+        os.remove(path)
+        for archive_path in restored:
+            log.info(f"Database archive written to {archive_path}")
+        return restored
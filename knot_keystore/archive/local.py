@@ -13,12 +13,14 @@
 
 import logging
 import os
-import shutil
-import stat
+import tempfile
+import time
 
 from cryptography.fernet import Fernet
 
-from knot_keystore.archive.base import ArchiveBase, with_encrypted_archive
+from knot_keystore.archive.base import (ArchiveBase, EncryptingWriter,
+                                        atomic_directory, atomic_open,
+                                        decrypt_stream)
 from knot_keystore.knot import Knot
 
 log = logging.getLogger(__name__)
@@ -27,64 +29,136 @@ log = logging.getLogger(__name__)
 class ArchiveLocal(ArchiveBase):
     """Archive knot kasp-db to local filesystem."""
 
-    @with_encrypted_archive
-    def exec(self, ciphertext_path=None, key=None):
-        """Execute archival proceedure."""
+    name = "local"
+
+    @property
+    def current_path(self):
+        """Get the path to the link to the current archive generation."""
+        return os.path.join(self.path, f"{self.archive_name}.current")
+
+    @property
+    def generation_path(self):
+        """Get the directory holding the current archive generation.
+
+        Archives written before generations were introduced are stored
+        directly in path, and are still read from there.
+        """
+        if not os.path.lexists(self.current_path):
+            return self.path
+        return self.current_path
+
+    @property
+    def archive_path(self):
+        """Get the path to the encrypted archive."""
+        return os.path.join(self.generation_path,
+                            f"{self.archive_filename}.enc")
+
+    @property
+    def key_path(self):
+        """Get the path to the encryption key."""
+        return os.path.join(self.generation_path, f"{self.archive_name}.key")
+
+    @property
+    def hash_path(self):
+        """Get the path to the archive hash."""
+        return os.path.join(self.generation_path,
+                            f"{self.archive_filename}.sha256")
+
+    def write_generation(self, key, generation_path, tmp_path):
+        """Write the encrypted archive, its key and hash to generation_path.
+
+        The archive is encrypted as it is created, straight into the
+        destination, and its sha256 hash is returned.
+        """
+        archive_path = os.path.join(generation_path,
+                                    f"{self.archive_filename}.enc")
+        with open(archive_path, "wb") as archive_file, \
+                EncryptingWriter(key, archive_file) as writer:
+            sha256_hash = self.write_cleartext_archive(writer, tmp_path)
+        key_path = os.path.join(generation_path, f"{self.archive_name}.key")
+        fd = os.open(key_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as key_file:
+            key_file.write(key)
+        hash_path = os.path.join(generation_path,
+                                 f"{self.archive_filename}.sha256")
+        with open(hash_path, "w") as hash_file:
+            hash_file.write(sha256_hash)
+        return sha256_hash
+
+    def exec(self):
+        """Execute archival proceedure.
+
+        Each run writes a new generation directory under the destination
+        path, which is then switched to in a single atomic step, so that a
+        crash never leaves a mismatched archive and key. The recorded store
+        time covers flushing and switching generations.
+        """
+        log.debug("Generating symetric encryption key")
+        key = Fernet.generate_key()
         log.debug(f"Trying to save encrypted archive to {self.path}")
         try:
-            archive_path = shutil.copy(src=ciphertext_path, dst=self.path)
+            with tempfile.TemporaryDirectory() as tmp_path:
+                with atomic_directory(self.current_path) as generation_path:
+                    self.write_generation(key, generation_path, tmp_path)
+                    store_start = time.monotonic()
+                store_seconds = time.monotonic() - store_start
         except Exception as e:
-            log.error(f"Failed to copy encrypted archive from \
-                        {ciphertext_path}: {e}")
+            log.error(f"Failed to write encrypted archive: {e}")
             raise e
-        log.info(f"Encrypted archive written to {archive_path}")
-        key_path = os.path.join(self.path, "kasp-db.key")
-        log.debug("Trying to write encryption key to file")
+        self.write_run_metrics(stored_bytes=os.path.getsize(self.archive_path),
+                               store_seconds=store_seconds)
+        log.info(f"Encrypted archive written to {self.archive_path}")
+        log.info(f"Encryption key written to {self.key_path}")
+        log.info(f"Archive hash written to {self.hash_path}")
+        return
+
+    def read_key(self):
+        """Read the encryption key."""
+        log.debug(f"Trying to read key from {self.key_path}")
         try:
-            with open(key_path, "wb") as key_file:
-                key_file.write(key)
-            os.chmod(key_path, stat.S_IRUSR | stat.S_IWUSR)
+            with open(self.key_path, "rb") as f:
+                return f.read()
         except Exception as e:
-            log.error(f"Failed to write encryption key to file: {e}")
+            log.error(f"Failed to read key from {self.key_path}: {e}")
             raise e
-        log.info(f"Encryption key written to {key_path}")
-        return
 
     def retrieve(self):
         """Retrieve and decrypt archive to the knot storage path."""
         log.debug(f"Trying to decrypt archive")
-        key_path = os.path.join(self.path, "kasp-db.key")
-        log.debug(f"Trying to read key from {key_path}")
-        try:
-            with open(key_path) as f:
-                key = f.read()
-            cipher = Fernet(key)
-        except Exception as e:
-            log.error(f"Failed to read key from {key_path}: {e}")
-            raise e
-        ciphertext_path = os.path.join(self.path, f"kasp-db.tar.xz.enc")
-        log.debug(f"Trying to read ciphertext from {ciphertext_path}")
-        try:
-            with open(ciphertext_path, "rb") as ciphertext_file:
-                ciphertext = ciphertext_file.read()
-        except Exception as e:
-            log.error(f"Failed to read ciphertext from {ciphertext_path}: {e}")
-            raise e
-        log.debug("Trying to decrypt ciphertext")
-        try:
-            cleartext = cipher.decrypt(ciphertext)
-        except Exception as e:
-            log.error(f"Failed to decrypt ciphertext: {e}")
-            raise e
+        key = self.read_key()
         with Knot(socket=self.knotc_socket) as knot:
             storage_path, kaspdb_dir = knot.kaspdb_path
-        cleartext_path = os.path.join(storage_path, "kasp-db.tar.xz")
-        log.debug(f"Trying to write cleartext to {cleartext_path}")
-        try:
-            with open(cleartext_path, "wb") as cleartext_file:
-                cleartext_file.write(cleartext)
-        except Exception as e:
-            log.error(f"Failed to write cleartext to {cleartext_path}: {e}")
-            raise e
-        log.info(f"Decrypted archive written to {cleartext_path}")
+            cleartext_path = os.path.join(storage_path, self.archive_filename)
+            log.debug(f"Trying to decrypt {self.archive_path} "
+                      f"to {cleartext_path}")
+            try:
+                with open(self.archive_path, "rb") as ciphertext_file, \
+                        atomic_open(cleartext_path) as cleartext_file:
+                    decrypt_stream(key, ciphertext_file, cleartext_file)
+            except Exception as e:
+                log.error(f"Failed to decrypt {self.archive_path}: {e}")
+                raise e
+            log.info(f"Decrypted archive written to {cleartext_path}")
+            self.restore_cleartext_archive(knot, cleartext_path)
         return
+
+    def list_generations(self):
+        """List stored archive generations."""
+        return ["current"]
+
+    def fetch_generation(self, generation, tmp_path):
+        """Decrypt the stored archive into tmp_path."""
+        key = self.read_key()
+        cleartext_path = os.path.join(tmp_path, self.archive_filename)
+        log.debug(f"Trying to decrypt {self.archive_path} "
+                  f"to {cleartext_path}")
+        with open(self.archive_path, "rb") as ciphertext_file, \
+                open(cleartext_path, "wb") as cleartext_file:
+            decrypt_stream(key, ciphertext_file, cleartext_file)
+        log.debug(f"Trying to read archive hash from {self.hash_path}")
+        try:
+            with open(self.hash_path) as f:
+                sha256_hash = f.read().strip()
+        except FileNotFoundError:
+            sha256_hash = None
+        return cleartext_path, sha256_hash
@@ -0,0 +1,206 @@
+# Copyright (c) 2019 Workonline Communications (Pty) Ltd. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""knot_keystore.archive.s3 module."""
+
+import logging
+import os
+import tempfile
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from knot_keystore.archive.base import (ArchiveBase, EncryptingWriter,
+                                        atomic_open, decrypt_stream)
+from knot_keystore.knot import Knot
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+
+class ArchiveS3(ArchiveBase):
+    """Archive knot kasp-db to S3-compatible object storage."""
+
+    name = "s3"
+    endpoint_url = None
+    region_name = None
+    access_key_id = None
+    secret_access_key = None
+    object_key = None
+    part_size = 8 * MiB
+    max_concurrency = 8
+
+    def __init__(self, *args, **kwargs):
+        """Initialise a new instance."""
+        super().__init__(*args, **kwargs)
+        if self.object_key is None:
+            self.object_key = f"{self.archive_filename}.enc"
+        log.debug("Trying to create an s3 client")
+        try:
+            self.client = self.get_client()
+        except Exception as e:
+            log.error(f"Failed to create s3 client: {e}")
+            raise e
+        self.transfer_config = TransferConfig(multipart_threshold=self.part_size,  # noqa: E501
+                                              multipart_chunksize=self.part_size,  # noqa: E501
+                                              max_concurrency=self.max_concurrency)  # noqa: E501
+
+    def get_client(self):
+        """Create an s3 client with a pool of reusable connections."""
+        pool_size = self.max_concurrency * self.verify_workers
+        session = boto3.session.Session(aws_access_key_id=self.access_key_id,
+                                        aws_secret_access_key=self.secret_access_key,  # noqa: E501
+                                        region_name=self.region_name)
+        return session.client("s3", endpoint_url=self.endpoint_url,
+                              config=Config(max_pool_connections=pool_size))
+
+    def get_object_hash(self, version_id=None):
+        """Check that bucket and object exist and get the sha256 hash."""
+        log.debug(f"Checking that bucket '{self.bucket_name}' exists")
+        try:
+            self.client.head_bucket(Bucket=self.bucket_name)
+        except ClientError as e:
+            log.error(f"Bucket {self.bucket_name} is not accessible: {e}")
+            raise e
+        log.debug(f"Checking whether object {self.object_key} exists")
+        kwargs = {"Bucket": self.bucket_name, "Key": self.object_key}
+        if version_id is not None:
+            kwargs["VersionId"] = version_id
+        try:
+            metadata = self.client.head_object(**kwargs)["Metadata"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            log.error(f"Failed to get object metadata: {e}")
+            raise e
+        log.debug("Getting content-sha256-hash metadata")
+        try:
+            hash = metadata["content-sha256-hash"]
+        except KeyError:
+            log.warning(f"Object {self.object_key} has no "
+                        "'content-sha256-hash' metadata")
+            hash = ""
+        return hash
+
+    def exec(self):
+        """Execute archival proceedure."""
+        log.debug("Tying to backup kasp-db to s3")
+        log.debug("Creating temp directory")
+        with tempfile.TemporaryDirectory() as tmp_path:
+            log.debug(f"Working in {tmp_path}")
+            path = os.path.join(tmp_path, f"{self.archive_filename}.enc")
+            with open(path, "wb") as f, \
+                    EncryptingWriter(self.encryption_key, f) as writer:
+                archive_sha256_hash = self.write_cleartext_archive(writer,
+                                                                   tmp_path)
+            object_sha256_hash = self.get_object_hash()
+            if object_sha256_hash is not None:
+                log.debug(f"Comparing local ('{archive_sha256_hash}') "
+                          f"and remote ('{object_sha256_hash}') sha256 "
+                          "hashes")
+                if archive_sha256_hash == object_sha256_hash:
+                    log.info("Content hashes match: exiting")
+                    self.write_run_metrics(skipped=True)
+                    return False
+            log.debug("Trying to store archive to s3")
+            metadata = {"content-sha256-hash": archive_sha256_hash}
+            store_start = time.monotonic()
+            try:
+                self.client.upload_file(path, self.bucket_name,
+                                        self.object_key,
+                                        ExtraArgs={"Metadata": metadata},
+                                        Config=self.transfer_config)
+            except Exception as e:
+                log.error(f"Failed to upload s3 object: {e}")
+                raise e
+            self.write_run_metrics(stored_bytes=os.path.getsize(path),
+                                   store_seconds=time.monotonic() - store_start)  # noqa: E501
+        log.info("Encrypted archive written to "
+                 f"{self.bucket_name}/{self.object_key}")
+
+    def get_stored_hash(self):
+        """Get the hash of the stored object, used to skip uploads."""
+        return self.get_object_hash()
+
+    def download(self, path, version_id=None):
+        """Download the object to path, using parallel ranged requests."""
+        log.debug(f"Trying to get archive from "
+                  f"{self.bucket_name}/{self.object_key}")
+        extra_args = {}
+        if version_id is not None:
+            extra_args["VersionId"] = version_id
+        try:
+            self.client.download_file(self.bucket_name, self.object_key,
+                                      path, ExtraArgs=extra_args,
+                                      Config=self.transfer_config)
+        except Exception as e:
+            log.error(f"Failed to download s3 object: {e}")
+            raise e
+
+    def retrieve(self):
+        """Retrieve and decrypt archive to the knot storage path."""
+        log.debug("Trying to retrieve kasp-db archive from s3")
+        with tempfile.TemporaryDirectory() as tmp_path, \
+                Knot(socket=self.knotc_socket) as knot:
+            ciphertext_path = os.path.join(tmp_path,
+                                           f"{self.archive_filename}.enc")
+            self.download(ciphertext_path)
+            storage_path, kaspdb_dir = knot.kaspdb_path
+            cleartext_path = os.path.join(storage_path, self.archive_filename)
+            log.debug(f"Trying to decrypt archive to {cleartext_path}")
+            try:
+                with open(ciphertext_path, "rb") as ciphertext_file, \
+                        atomic_open(cleartext_path) as cleartext_file:
+                    decrypt_stream(self.encryption_key, ciphertext_file,
+                                   cleartext_file)
+            except Exception as e:
+                log.error(f"Failed to decrypt archive: {e}")
+                raise e
+            log.info(f"Decrypted archive written to {cleartext_path}")
+            self.restore_cleartext_archive(knot, cleartext_path)
+        return
+
+    def list_generations(self):
+        """List the stored versions of the object."""
+        log.debug(f"Trying to list versions of "
+                  f"{self.bucket_name}/{self.object_key}")
+        generations = []
+        try:
+            paginator = self.client.get_paginator("list_object_versions")
+            for page in paginator.paginate(Bucket=self.bucket_name,
+                                           Prefix=self.object_key):
+                for version in page.get("Versions", []):
+                    if version["Key"] == self.object_key:
+                        generations.append(version["VersionId"])
+        except Exception as e:
+            log.error(f"Failed to list s3 object versions: {e}")
+            raise e
+        return generations
+
+    def fetch_generation(self, generation, tmp_path):
+        """Download and decrypt an object version into tmp_path."""
+        version_id = None if generation == "null" else generation
+        ciphertext_path = os.path.join(tmp_path,
+                                       f"{self.archive_filename}.enc")
+        cleartext_path = os.path.join(tmp_path, self.archive_filename)
+        sha256_hash = self.get_object_hash(version_id) or None
+        self.download(ciphertext_path, version_id)
+        log.debug(f"Trying to decrypt {ciphertext_path} to {cleartext_path}")
+        with open(ciphertext_path, "rb") as ciphertext_file, \
+                open(cleartext_path, "wb") as cleartext_file:
+            decrypt_stream(self.encryption_key, ciphertext_file,
+                           cleartext_file)
+        return cleartext_path, sha256_hash
@@ -12,6 +12,7 @@
 """knot_keystore cli module."""
 
 import argparse
+import json
 import logging
 
 import yaml
@@ -33,9 +34,17 @@ def parse_args():
                         choices=get_plugins(),
                         nargs="*",
                         help="select archival plugins")
-    parser.add_argument("--retrieve", "-r",
-                        action="store_true",
-                        help="retrieve archive")
+    operation = parser.add_mutually_exclusive_group()
+    operation.add_argument("--retrieve", "-r",
+                           action="store_true",
+                           help="retrieve archive")
+    operation.add_argument("--verify", "-V",
+                           action="store_true",
+                           help="verify stored archives without restoring")
+    operation.add_argument("--plan", "-P",
+                           action="store_true",
+                           help="predict the cost of an archival run, "
+                                "as JSON, without freezing knot")
     parser.add_argument("--config-file", "-c",
                         default=DEFAULT_CONFIG_PATH,
                         help="path to a configuration file")
@@ -80,6 +89,7 @@ def main():
         args = parse_args()
         set_loglevel(verbosity=args.verbosity)
         config = read_config(file=args.config_file)
+        plans = []
         for plugin_name in config.plugins.keys():
             if args.plugins and plugin_name not in args.plugins:
                 continue
@@ -90,8 +100,14 @@ def main():
             if args.retrieve:
                 plugin.retrieve()
                 break
+            elif args.verify:
+                plugin.verify()
+            elif args.plan:
+                plans.append(plugin.plan())
             else:
                 plugin.exec()
+        if args.plan:
+            print(json.dumps({"plans": plans}, indent=2))
     except KeyboardInterrupt:
         log.error("Caught keyboard interrupt: aborting")
         return 130
@@ -11,6 +11,8 @@
 # the License.
 """knot_keystore knot module."""
 
+import asyncio
+import concurrent.futures
 import contextlib
 import logging
 import os
@@ -20,12 +22,22 @@ import libknot.control
 
 log = logging.getLogger(__name__)
 
+# asyncio.get_running_loop is only available from python 3.7
+get_running_loop = getattr(asyncio, "get_running_loop",
+                           asyncio.get_event_loop)
+
 
 class Knot(object):
     """A knot-dns control object."""
 
     STORAGE = "/var/lib/knot"
+    FREEZE_POLL_INTERVAL = 1
+    FREEZE_TIMEOUT = 60
     KASP_DB = "keys"
+    DATABASES = {"kasp-db": KASP_DB,
+                 "journal-db": "journal",
+                 "timer-db": "timers",
+                 "catalog-db": "catalog"}
 
     def __init__(self, socket=None):
         """Intitialise a new instance."""
@@ -76,26 +88,49 @@ class Knot(object):
     def kaspdb_path(self):
         """Find the path to the kasp-db directory."""
         log.debug("Trying to find kasp-db location")
-        config = self.config
+        return self.parse_kaspdb_path(self.config)
+
+    @property
+    def database_paths(self):
+        """Find the paths to all of knot's LMDB database directories."""
+        log.debug("Trying to find knot database locations")
+        return self.parse_database_paths(self.config)
+
+    @classmethod
+    def _lookup(cls, config, item, default):
+        """Find an item in the database section or default template."""
+        for section in (("database",), ("template", "default")):
+            try:
+                value = config
+                for key in section:
+                    value = value[key]
+                return value[item][0]
+            except KeyError:
+                continue
+        log.debug(f"No configured '{item}' in database section or default "
+                  f"template: using default value '{default}'")
+        return default
+
+    @classmethod
+    def parse_database_paths(cls, config):
+        """Find the paths to all LMDB database directories in a config."""
         log.debug("Checking for configured knot storage path")
-        try:
-            storage = config["template"]["default"]["storage"][0]
-        except KeyError:
-            log.debug(f"No configured 'storage' in default template: "
-                      f"using default value '{self.STORAGE}'")
-            storage = self.STORAGE
+        storage = cls._lookup(config, "storage", cls.STORAGE)
         log.debug(f"Storage path is {storage}")
-        log.debug("Checking for configured kasp-db path")
-        try:
-            kasp_db = config["template"]["default"]["kasp-db"][0]
-        except KeyError:
-            log.debug(f"No configured 'kasp-db' in default template: "
-                      f"using default value '{self.KASP_DB}'")
-            kasp_db = self.KASP_DB
-        if not kasp_db.startswith("/"):
-            kasp_db = os.path.join(storage, kasp_db)
-        log.info(f"Path to kasp-db: {kasp_db}")
-        return os.path.split(kasp_db)
+        paths = {}
+        for name, default in cls.DATABASES.items():
+            log.debug(f"Checking for configured {name} path")
+            path = cls._lookup(config, name, default)
+            if not path.startswith("/"):
+                path = os.path.join(storage, path)
+            log.info(f"Path to {name}: {path}")
+            paths[name] = os.path.split(path)
+        return paths
+
+    @classmethod
+    def parse_kaspdb_path(cls, config):
+        """Find the path to the kasp-db directory in a running config."""
+        return cls.parse_database_paths(config)["kasp-db"]
 
     @contextlib.contextmanager
     def freeze(self):
@@ -103,15 +138,171 @@ class Knot(object):
         log.debug("Trying to freeze knot zone operations")
         self._cmd(cmd="zone-freeze")
         log.debug("Waiting for all zones to become frozen")
-        while True:
-            time.sleep(1)
-            for s in self.zone_status.values():
-                if s["freeze"] != "yes":  # pragma: no cover
-                    continue
-            break
+        deadline = time.monotonic() + self.FREEZE_TIMEOUT
+        while not all(s["freeze"] == "yes"
+                      for s in self.zone_status.values()):
+            if time.monotonic() > deadline:  # pragma: no cover
+                log.error("Timed out waiting for zones to become frozen")
+                self._cmd(cmd="zone-thaw")
+                raise RuntimeError("Timed out freezing zone operations")
+            time.sleep(self.FREEZE_POLL_INTERVAL)
         log.debug("Sucessfully froze zone operations")
         try:
             yield
         finally:
             log.debug("Thawing knot zone operations")
             self._cmd(cmd="zone-thaw")
+
+
+class AsyncKnot(object):
+    """An asyncio knot-dns control object.
+
+    The blocking libknot control calls are run in a dedicated executor
+    thread, so that control I/O can overlap with other work on the event
+    loop. The executor lives for the duration of the connection context,
+    so an instance may be re-entered after it has been exited.
+    """
+
+    FREEZE_POLL_INTERVAL = 0.1
+    FREEZE_TIMEOUT = 60
+
+    def __init__(self, socket=None):
+        """Intitialise a new instance."""
+        log.debug(f"Initialising async knot control instance {self}")
+        self.socket = socket
+        self.ctl = libknot.control.KnotCtl()
+        self.executor = None
+
+    async def _run(self, func, *args):
+        """Run a blocking call in the control executor thread."""
+        loop = get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def __aenter__(self):
+        """Enter connection context."""
+        log.debug(f"Connecting to knot control socket: {self.socket}")
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        try:
+            await self._run(self.ctl.connect, self.socket)
+        except Exception as e:
+            log.error(f"Failed to connect to knot conrol socket: {e}")
+            self._shutdown()
+            raise e
+        log.debug("Connected to knot control socket")
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Exit connection context."""
+        log.debug("Disconnecting from knot control socket")
+        try:
+            await self._run(self.ctl.send, libknot.control.KnotCtlType.END)
+            await self._run(self.ctl.close)
+        finally:
+            self._shutdown()
+        log.debug("Disconnected from knot control socket")
+        return None
+
+    def _shutdown(self):
+        """Shut down the control executor thread."""
+        self.executor.shutdown(wait=False)
+        self.executor = None
+
+    def _pipeline(self, cmds):
+        """Send all control commands, then receive all the results.
+
+        Every response is read, even after an error, so that the
+        connection is left in step for the next command. The first error
+        is then raised.
+        """
+        for cmd, kwargs in cmds:
+            log.debug(f"Sending control command '{cmd}' to knot")
+            self.ctl.send_block(cmd, **kwargs)
+        resps = []
+        errors = []
+        for cmd, _ in cmds:
+            try:
+                resps.append(self.ctl.receive_block())
+            except libknot.control.KnotCtlErrorRemote as e:
+                log.error(f"Control command '{cmd}' failed: {e}")
+                resps.append(None)
+                errors.append(e)
+        log.debug(f"Got responses from knot: {resps}")
+        if errors:
+            raise errors[0]
+        return resps
+
+    async def pipeline(self, *cmds):
+        """Pipeline (cmd, kwargs) pairs and return the results in order."""
+        return await self._run(self._pipeline, cmds)
+
+    async def cmd(self, cmd=None, **kwargs):
+        """Send a control command and return a result."""
+        resp, = await self.pipeline((cmd, kwargs))
+        return resp
+
+    async def zone_status(self, *zones):
+        """Get operational zone status, for all zones or those given."""
+        log.debug("Trying to get knot zone status")
+        if not zones:
+            return await self.cmd(cmd="zone-status")
+        status = {}
+        for resp in await self.pipeline(*(("zone-status", {"zone": zone})
+                                          for zone in zones)):
+            status.update(resp)
+        return status
+
+    async def config(self):
+        """Read the running config from knot."""
+        log.debug("Trying to get knot running config")
+        return await self.cmd(cmd="conf-read")
+
+    async def kaspdb_path(self):
+        """Find the path to the kasp-db directory."""
+        log.debug("Trying to find kasp-db location")
+        return Knot.parse_kaspdb_path(await self.config())
+
+    async def database_paths(self):
+        """Find the paths to all of knot's LMDB database directories."""
+        log.debug("Trying to find knot database locations")
+        return Knot.parse_database_paths(await self.config())
+
+    def freeze(self):
+        """Freeze zone operations, for use as an async context manager."""
+        return AsyncFreeze(self)
+
+
+class AsyncFreeze(object):
+    """Async context manager that keeps knot zone operations frozen."""
+
+    def __init__(self, knot):
+        """Intitialise a new instance."""
+        self.knot = knot
+
+    async def _wait_frozen(self):
+        """Poll zone status until every zone is frozen."""
+        while True:
+            status = await self.knot.zone_status()
+            if all(s.get("freeze") == "yes" for s in status.values()):
+                return
+            await asyncio.sleep(self.knot.FREEZE_POLL_INTERVAL)
+
+    async def __aenter__(self):
+        """Freeze zone operations."""
+        log.debug("Trying to freeze knot zone operations")
+        await self.knot.cmd(cmd="zone-freeze")
+        log.debug("Waiting for all zones to become frozen")
+        try:
+            await asyncio.wait_for(self._wait_frozen(),
+                                   self.knot.FREEZE_TIMEOUT)
+        except Exception as e:
+            log.error(f"Failed to freeze zone operations: {e}")
+            await self.knot.cmd(cmd="zone-thaw")
+            raise e
+        log.debug("Sucessfully froze zone operations")
+        return self.knot
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Thaw zone operations."""
+        log.debug("Thawing knot zone operations")
+        await self.knot.cmd(cmd="zone-thaw")
+        return None
@@ -0,0 +1,103 @@
+# Copyright (c) 2019 Workonline Communications (Pty) Ltd. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""knot_keystore azure plugin tests."""
+
+import unittest.mock
+
+from azure.keyvault import KeyId
+
+from knot_keystore.archive.azure import KeyCache, KeyEncryptionKey
+
+VAULT_URL = "https://knot-keystore.vault.azure.net"
+
+
+def key(name):
+    """Get a cache key for a named stand-in wrapped CEK."""
+    return KeyCache.key("kid", name.encode(), "RSA-OAEP-256")
+
+
+class TestKeyCache(object):
+    """Unwrapped content encryption key cache test class."""
+
+    def test_get(self):
+        """Test cached keys are returned, and others are not."""
+        cache = KeyCache(size=2, ttl=300)
+        cache.put(key("a"), b"cek-a")
+        assert cache.get(key("a")) == b"cek-a"
+        assert cache.get(key("b")) is None
+
+    def test_lru(self):
+        """Test the least recently used key is evicted."""
+        cache = KeyCache(size=2, ttl=300)
+        cache.put(key("a"), b"cek-a")
+        cache.put(key("b"), b"cek-b")
+        cache.get(key("a"))
+        cache.put(key("c"), b"cek-c")
+        assert cache.get(key("b")) is None
+        assert cache.get(key("a")) == b"cek-a"
+        assert cache.get(key("c")) == b"cek-c"
+
+    def test_contains(self):
+        """Test checking for a key does not make it recently used."""
+        cache = KeyCache(size=2, ttl=300)
+        cache.put(key("a"), b"cek-a")
+        cache.put(key("b"), b"cek-b")
+        assert key("a") in cache
+        assert key("c") not in cache
+        cache.put(key("c"), b"cek-c")
+        assert key("a") not in cache
+        assert key("b") in cache
+
+    def test_ttl(self):
+        """Test keys expire after the ttl."""
+        cache = KeyCache(size=2, ttl=300)
+        with unittest.mock.patch("time.monotonic", return_value=1000):
+            cache.put(key("a"), b"cek-a")
+        with unittest.mock.patch("time.monotonic", return_value=1299):
+            assert cache.get(key("a")) == b"cek-a"
+        with unittest.mock.patch("time.monotonic", return_value=1300):
+            assert cache.get(key("a")) is None
+        assert not cache.entries
+
+    def test_zeroed(self):
+        """Test evicted, expired and cleared key material is overwritten."""
+        cache = KeyCache(size=1, ttl=300)
+        with unittest.mock.patch("time.monotonic", return_value=1000):
+            cache.put(key("a"), b"cek-a")
+            evicted = cache.entries[key("a")][1]
+            cache.put(key("b"), b"cek-b")
+            expired = cache.entries[key("b")][1]
+        with unittest.mock.patch("time.monotonic", return_value=2000):
+            cache.get(key("b"))
+            cache.put(key("c"), b"cek-c")
+            cleared = cache.entries[key("c")][1]
+            cache.clear()
+        for value in (evicted, expired, cleared):
+            assert value == bytearray(5)
+
+
+class TestKeyEncryptionKey(object):
+    """Key vault KEK test class."""
+
+    def test_wrap_key_version(self):
+        """Test wrapping records the versioned id of the KEK used."""
+        versioned_kid = f"{VAULT_URL}/keys/kek/0123456789abcdef"
+        resolver = unittest.mock.Mock(alg="RSA-OAEP-256")
+        resolver.client.wrap_key.return_value = unittest.mock.Mock(kid=versioned_kid,  # noqa: E501
+                                                                   result=b"wrapped")  # noqa: E501
+        kek = KeyEncryptionKey(resolver=resolver,
+                               kid=KeyId(vault=VAULT_URL, name="kek"))
+        assert kek.wrap_key(b"cek") == b"wrapped"
+        resolver.client.wrap_key.assert_called_once_with(VAULT_URL, "kek", "",
+                                                         "RSA-OAEP-256",
+                                                         b"cek")
+        assert kek.get_kid() == versioned_kid
@@ -0,0 +1,202 @@
+# Copyright (c) 2019 Workonline Communications (Pty) Ltd. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""knot_keystore.archive.base module tests."""
+
+import io
+import os
+
+from cryptography.fernet import Fernet, InvalidToken
+
+import pytest
+
+from knot_keystore.archive.base import (ArchiveBase, EncryptingWriter,
+                                        atomic_directory, decrypt_stream)
+
+CLEARTEXT = os.urandom(200 * 1024 + 7)
+
+
+class TestEncryptingWriter(object):
+    """Streaming fernet encryption test class."""
+
+    def encrypt(self, key, data, write_size):
+        """Encrypt data, writing it in write_size pieces."""
+        ciphertext = io.BytesIO()
+        with EncryptingWriter(key, ciphertext) as writer:
+            for i in range(0, len(data), write_size):
+                writer.write(data[i:i + write_size])
+        return ciphertext.getvalue()
+
+    @pytest.mark.parametrize("size", (0, 1, 15, 16, 17, 4096, len(CLEARTEXT)))
+    def test_fernet_decrypt(self, size):
+        """Test tokens of varying length are decrypted by fernet."""
+        key = Fernet.generate_key()
+        data = CLEARTEXT[:size]
+        assert Fernet(key).decrypt(self.encrypt(key, data, 1024)) == data
+
+    @pytest.mark.parametrize("write_size", (1, 3, 7, 1000, 65537))
+    def test_write_sizes(self, write_size):
+        """Test the token does not depend on how writes are split."""
+        key = Fernet.generate_key()
+        data = CLEARTEXT[:70000]
+        assert Fernet(key).decrypt(self.encrypt(key, data, write_size)) == data
+
+
+class TestDecryptStream(object):
+    """Streaming fernet decryption test class."""
+
+    def decrypt(self, key, token, chunk_size=1024):
+        """Decrypt a token, reading it in chunk_size pieces."""
+        cleartext = io.BytesIO()
+        decrypt_stream(key, io.BytesIO(token), cleartext, chunk_size)
+        return cleartext.getvalue()
+
+    @pytest.mark.parametrize("size", (0, 1, 15, 16, 17, 4096, len(CLEARTEXT)))
+    def test_fernet_encrypt(self, size):
+        """Test tokens of varying length from fernet are decrypted."""
+        key = Fernet.generate_key()
+        data = CLEARTEXT[:size]
+        assert self.decrypt(key, Fernet(key).encrypt(data)) == data
+
+    @pytest.mark.parametrize("chunk_size", (1, 3, 5, 57, 1000, 65537))
+    def test_chunk_sizes(self, chunk_size):
+        """Test decryption does not depend on how reads are split."""
+        key = Fernet.generate_key()
+        data = CLEARTEXT[:70000]
+        ciphertext = io.BytesIO()
+        with EncryptingWriter(key, ciphertext) as writer:
+            writer.write(data)
+        assert self.decrypt(key, ciphertext.getvalue(), chunk_size) == data
+
+    @pytest.mark.parametrize("offset", (0, 5, 20, 40, 200, -50, -10, -3))
+    def test_tampered(self, offset):
+        """Test a token with one character changed is rejected."""
+        key = Fernet.generate_key()
+        token = bytearray(Fernet(key).encrypt(CLEARTEXT[:1000]))
+        token[offset] = ord("A") if token[offset] != ord("A") else ord("B")
+        with pytest.raises(InvalidToken):
+            self.decrypt(key, bytes(token))
+
+    @pytest.mark.parametrize("length", (0, 1, 4, 30, 100, -44, -4, -1))
+    def test_truncated(self, length):
+        """Test a truncated token is rejected."""
+        key = Fernet.generate_key()
+        token = Fernet(key).encrypt(CLEARTEXT[:1000])
+        with pytest.raises(InvalidToken):
+            self.decrypt(key, token[:length])
+
+    def test_invalid_characters(self):
+        """Test a token that is not valid base64 is rejected."""
+        key = Fernet.generate_key()
+        token = Fernet(key).encrypt(CLEARTEXT[:1000])
+        with pytest.raises(InvalidToken):
+            self.decrypt(key, token[:100] + b"=" + token[101:])
+
+    def test_wrong_key(self):
+        """Test a token encrypted under another key is rejected."""
+        token = Fernet(Fernet.generate_key()).encrypt(CLEARTEXT[:1000])
+        with pytest.raises(InvalidToken):
+            self.decrypt(Fernet.generate_key(), token)
+
+
+class TestAtomicDirectory(object):
+    """Atomic generation switch test class."""
+
+    def write(self, link_path, content):
+        """Write a generation containing a single file."""
+        with atomic_directory(link_path) as path:
+            with open(os.path.join(path, "file"), "w") as f:
+                f.write(content)
+
+    def read(self, link_path):
+        """Read the file from the current generation."""
+        with open(os.path.join(link_path, "file")) as f:
+            return f.read()
+
+    def test_switch(self, tmp_path):
+        """Test each generation replaces the last, which is removed."""
+        link_path = str(tmp_path / "current")
+        self.write(link_path, "first")
+        assert self.read(link_path) == "first"
+        self.write(link_path, "second")
+        assert self.read(link_path) == "second"
+        assert sorted(os.listdir(str(tmp_path))) == \
+            sorted(["current", os.readlink(link_path)])
+
+    def test_failure(self, tmp_path):
+        """Test a failed generation leaves the current one in place."""
+        link_path = str(tmp_path / "current")
+        self.write(link_path, "first")
+        entries = sorted(os.listdir(str(tmp_path)))
+        with pytest.raises(RuntimeError):
+            with atomic_directory(link_path) as path:
+                with open(os.path.join(path, "file"), "w") as f:
+                    f.write("second")
+                raise RuntimeError
+        assert self.read(link_path) == "first"
+        assert sorted(os.listdir(str(tmp_path))) == entries
+
+
+class BatchedArchive(ArchiveBase):
+    """Stand-in plugin that records the order of verification steps."""
+
+    name = "batched"
+    generations = 10
+
+    def __init__(self, *args, **kwargs):
+        """Initialise a new instance."""
+        super().__init__(*args, **kwargs)
+        self.events = []
+
+    def list_generations(self):
+        """List stand-in generations."""
+        return list(range(self.generations))
+
+    def prepare_generations(self, generations):
+        """Record the batch being prepared."""
+        self.events.append(("prepare", list(generations)))
+
+    def verify_generation(self, generation):
+        """Record the generation being verified."""
+        self.events.append(("verify", generation))
+        return {"status": "ok"}
+
+
+class TestVerify(object):
+    """Batched verification test class."""
+
+    def test_batches(self):
+        """Test each batch is prepared just before it is verified."""
+        plugin = BatchedArchive(config={"verify_batch_size": 3})
+        assert len(plugin.verify()) == 10
+        batches = []
+        for event, value in plugin.events:
+            if event == "prepare":
+                batches.append((value, []))
+            else:
+                batches[-1][1].append(value)
+        assert [prepared for prepared, verified in batches] == \
+            [[0, 1, 2], [3, 4, 5], [6, 7, 8], [9]]
+        assert all(sorted(verified) == prepared
+                   for prepared, verified in batches)
+
+    def test_single_batch(self):
+        """Test all generations are prepared at once by default."""
+        plugin = BatchedArchive()
+        plugin.verify()
+        assert plugin.events[0] == ("prepare", list(range(10)))
+
+    def test_empty(self):
+        """Test verification fails if no generations are stored."""
+        plugin = BatchedArchive(config={"generations": 0})
+        with pytest.raises(RuntimeError):
+            plugin.verify()
+        assert not plugin.events
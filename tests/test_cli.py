@@ -11,24 +11,143 @@
 # the License.
 """knot_keystore cli module tests."""
 
+import json
+import os
+import shutil
 import unittest.mock
 
 import pytest
 
+import yaml
+
 from knot_keystore.archive import get_plugins
+from knot_keystore.archive.base import (fingerprint_databases, make_xztar,
+                                        sha256_file)
+from knot_keystore.archive.local import ArchiveLocal
 from knot_keystore.cli import main
 
 
+RUN = {"operation": "exec", "plugin": "local", "all_databases": False,
+       "source_bytes": 1000, "archive_seconds": 1.0, "freeze_seconds": 1.5,
+       "archive_bytes": 500, "stored_bytes": 700, "store_seconds": 0.7,
+       "skipped": False}
+
+
+@pytest.fixture
+def kaspdb_path(tmp_path):
+    """Create a stand-in kasp-db of 4096 bytes."""
+    path = tmp_path / "storage" / "keys"
+    path.mkdir(parents=True)
+    (path / "data.mdb").write_bytes(os.urandom(4096))
+    return str(path.parent), path.name
+
+
+@pytest.fixture
+def local_archive(tmp_path, kaspdb_path):
+    """Store a local archive of a stand-in kasp-db, without using knot."""
+    cleartext_path = make_xztar(str(tmp_path / "kasp-db"), *kaspdb_path)
+
+    def write_cleartext_archive(self, fileobj, tmp_path):
+        with open(cleartext_path, "rb") as f:
+            shutil.copyfileobj(f, fileobj)
+        return sha256_file(cleartext_path)
+
+    config = {"path": str(tmp_path)}
+    plugin = ArchiveLocal(config=config)
+    with unittest.mock.patch.object(ArchiveLocal, "write_cleartext_archive",
+                                    write_cleartext_archive):
+        plugin.exec()
+    config_file = tmp_path / "knot-keystore.yaml"
+    config_file.write_text(yaml.safe_dump({"plugins": {"local": config}}))
+    return plugin, str(config_file)
+
+
+def verify(config_file):
+    """Run the CLI in verify mode and return its exit code."""
+    args = ["knot-keystore", "--plugins", "local", "--verify",
+            "--config-file", config_file]
+    with unittest.mock.patch("sys.argv", args):
+        return main()
+
+
 class TestCli(object):
     """CLI test class."""
 
     @pytest.mark.parametrize("plugin", get_plugins())
-    @pytest.mark.parametrize("operation", ("archive", "retrieve"))
+    @pytest.mark.parametrize("operation", ("archive", "retrieve", "verify",
+                                           "plan"))
     def test_cli(self, plugin, operation):
         """Test CLI."""
         args = ["knot-keystore", "--plugins", plugin]
-        if operation == "retrieve":
-            args.append("--retrieve")
+        if operation in ("retrieve", "verify", "plan"):
+            args.append(f"--{operation}")
         with unittest.mock.patch("sys.argv", args):
             retval = main()
         assert retval == 0
+
+    def test_key_mode(self, local_archive):
+        """Test the stored encryption key is only readable by its owner."""
+        plugin, config_file = local_archive
+        assert os.stat(plugin.key_path).st_mode & 0o777 == 0o600
+
+    def test_verify(self, local_archive):
+        """Test verifying an intact archive."""
+        plugin, config_file = local_archive
+        assert verify(config_file) == 0
+
+    def test_verify_corrupt(self, local_archive):
+        """Test verifying a corrupted archive fails."""
+        plugin, config_file = local_archive
+        with open(plugin.archive_path, "r+b") as f:
+            f.seek(100)
+            c = f.read(1)
+            f.seek(100)
+            f.write(b"A" if c != b"A" else b"B")
+        assert verify(config_file) == 1
+
+    def test_verify_hash_mismatch(self, local_archive):
+        """Test verifying an archive against the wrong hash fails."""
+        plugin, config_file = local_archive
+        with open(plugin.hash_path, "w") as f:
+            f.write("0" * 64)
+        assert verify(config_file) == 1
+
+    @pytest.mark.parametrize("changed", (False, True))
+    @pytest.mark.parametrize("stored_hash", (None, "aaaa", "bbbb"))
+    def test_plan(self, tmp_path, kaspdb_path, capsys, changed, stored_hash):
+        """Test planning from a seeded metrics file."""
+        source_bytes, fingerprint = fingerprint_databases([kaspdb_path])
+        metrics_path = tmp_path / "metrics.jsonl"
+        history = [dict(RUN, fingerprint="0" * 64, sha256_hash="bbbb"),
+                   dict(RUN, fingerprint="0" * 64 if changed else fingerprint,
+                        sha256_hash="aaaa")]
+        metrics_path.write_text("".join(json.dumps(record) + "\n"
+                                        for record in history))
+        config = {"path": str(tmp_path), "metrics_path": str(metrics_path)}
+        config_file = tmp_path / "knot-keystore.yaml"
+        config_file.write_text(yaml.safe_dump({"plugins": {"local": config}}))
+        knot = unittest.mock.MagicMock()
+        knot.return_value.__enter__.return_value.kaspdb_path = kaspdb_path
+        args = ["knot-keystore", "--plugins", "local", "--plan",
+                "--config-file", str(config_file)]
+        with unittest.mock.patch("knot_keystore.archive.base.Knot", knot), \
+                unittest.mock.patch.object(ArchiveLocal, "get_stored_hash",
+                                           return_value=stored_hash), \
+                unittest.mock.patch("sys.argv", args):
+            assert main() == 0
+        plan, = json.loads(capsys.readouterr().out)["plans"]
+        assert plan["source_bytes"] == source_bytes == 4096
+        assert plan["fingerprint"] == fingerprint
+        assert plan["calibration_runs"] == 2
+        assert plan["changed"] == changed
+        if stored_hash is None:
+            assert plan["dedup_skip"] is None
+        else:
+            assert plan["dedup_skip"] == (not changed and
+                                          stored_hash == "aaaa")
+        predicted = {"archive_seconds": 4.096, "freeze_seconds": 4.596,
+                     "archive_bytes": 2048, "stored_bytes": 2867,
+                     "store_seconds": 2.867}
+        if plan["dedup_skip"]:
+            predicted.update(stored_bytes=0, store_seconds=0)
+        assert plan["predicted"] == predicted
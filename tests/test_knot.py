@@ -0,0 +1,79 @@
+# Copyright (c) 2019 Workonline Communications (Pty) Ltd. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""knot_keystore knot module tests."""
+
+import asyncio
+
+import libknot.control
+
+import pytest
+
+from knot_keystore.knot import AsyncKnot, Knot
+
+SOCKET = "/run/knot/knot.sock"
+
+
+class TestAsyncKnot(object):
+    """Async knot control client test class."""
+
+    def run(self, coro):
+        """Run a coroutine to completion."""
+        return asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_kaspdb_path(self):
+        """Test kasp-db path matches the blocking client."""
+        async def kaspdb_path():
+            async with AsyncKnot(socket=SOCKET) as knot:
+                return await knot.kaspdb_path()
+        with Knot(socket=SOCKET) as knot:
+            expected = knot.kaspdb_path
+        assert self.run(kaspdb_path()) == expected
+
+    def test_freeze(self):
+        """Test freezing and pipelined zone status."""
+        async def freeze():
+            async with AsyncKnot(socket=SOCKET) as knot:
+                zones = list(await knot.zone_status())
+                async with knot.freeze():
+                    frozen = await knot.zone_status(*zones)
+                thawed = await knot.zone_status(*zones)
+            return zones, frozen, thawed
+        zones, frozen, thawed = self.run(freeze())
+        assert zones
+        assert set(frozen) == set(zones)
+        assert all(s["freeze"] == "yes" for s in frozen.values())
+        assert not any(s["freeze"] == "yes" for s in thawed.values())
+
+    def test_pipeline_error(self):
+        """Test a failed command leaves the connection usable."""
+        async def pipeline():
+            async with AsyncKnot(socket=SOCKET) as knot:
+                with pytest.raises(libknot.control.KnotCtlErrorRemote):
+                    await knot.pipeline(("zone-status",
+                                         {"zone": "nonexistent.invalid."}),
+                                        ("conf-read", {}))
+                return await knot.config()
+        with Knot(socket=SOCKET) as knot:
+            expected = knot.config
+        assert self.run(pipeline()) == expected
+
+    def test_reenter(self):
+        """Test the client can be re-entered after it has been exited."""
+        async def reenter():
+            client = AsyncKnot(socket=SOCKET)
+            async with client as knot:
+                first = await knot.kaspdb_path()
+            async with client as knot:
+                second = await knot.kaspdb_path()
+            return first, second
+        first, second = self.run(reenter())
+        assert first == second
@@ -0,0 +1,120 @@
+# Copyright (c) 2019 Workonline Communications (Pty) Ltd. All rights reserved.
+#
+# The contents of this file are licensed under the MIT License
+# (the "License"); you may not use this file except in compliance with the
+# License.
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""knot_keystore s3 plugin tests, against a local S3 stand-in server."""
+
+import json
+import unittest.mock
+import uuid
+
+import boto3
+
+from cryptography.fernet import Fernet
+
+from moto.server import ThreadedMotoServer
+
+import pytest
+
+import yaml
+
+from knot_keystore.archive.s3 import ArchiveS3
+from knot_keystore.cli import main
+
+HOST = "127.0.0.1"
+CREDENTIALS = {"access_key_id": "testing",
+               "secret_access_key": "testing",
+               "region_name": "us-east-1"}
+
+
+@pytest.fixture(scope="module")
+def endpoint_url():
+    """Start an S3 stand-in server on a free port."""
+    server = ThreadedMotoServer(ip_address=HOST, port=0, verbose=False)
+    server.start()
+    host, port = server.get_host_and_port()
+    yield f"http://{host}:{port}"
+    server.stop()
+
+
+@pytest.fixture
+def config_file(endpoint_url, tmp_path):
+    """Create an empty versioned bucket and write a plugin config for it."""
+    bucket = f"knot-keystore-{uuid.uuid4().hex}"
+    client = boto3.client("s3", endpoint_url=endpoint_url,
+                          aws_access_key_id=CREDENTIALS["access_key_id"],
+                          aws_secret_access_key=CREDENTIALS["secret_access_key"],  # noqa: E501
+                          region_name=CREDENTIALS["region_name"])
+    client.create_bucket(Bucket=bucket)
+    client.put_bucket_versioning(Bucket=bucket,
+                                 VersioningConfiguration={"Status": "Enabled"})
+    config = {"plugins": {"s3": dict(CREDENTIALS,
+                                     endpoint_url=endpoint_url,
+                                     bucket_name=bucket,
+                                     encryption_key=Fernet.generate_key().decode(),  # noqa: E501
+                                     part_size=5 * 1024 * 1024,
+                                     max_concurrency=4,
+                                     metrics_path=str(tmp_path / "metrics.jsonl"))}}  # noqa: E501
+    path = tmp_path / "knot-keystore.yaml"
+    path.write_text(yaml.safe_dump(config))
+    return str(path)
+
+
+@pytest.fixture
+def archived(config_file):
+    """Store an archive in the bucket."""
+    assert run(config_file) == 0
+    return config_file
+
+
+def run(config_file, *args):
+    """Run the CLI with the s3 plugin and return its exit code."""
+    argv = ["knot-keystore", "--plugins", "s3",
+            "--config-file", config_file, *args]
+    with unittest.mock.patch("sys.argv", argv):
+        return main()
+
+
+class TestS3(object):
+    """S3 plugin test class."""
+
+    @pytest.mark.parametrize("config, object_key", (
+        ({}, "kasp-db.tar.xz.enc"),
+        ({"all_databases": True}, "knot-db.tar.enc"),
+        ({"all_databases": True, "object_key": "archive"}, "archive"),
+    ))
+    def test_object_key(self, endpoint_url, config, object_key):
+        """Test the default object key follows the archive format."""
+        plugin = ArchiveS3(config=dict(CREDENTIALS, endpoint_url=endpoint_url,
+                                       **config))
+        assert plugin.object_key == object_key
+
+    def test_archive(self, config_file):
+        """Test archiving to an empty bucket."""
+        assert run(config_file) == 0
+
+    def test_verify_empty(self, config_file):
+        """Test verifying an empty bucket fails."""
+        assert run(config_file, "--verify") == 1
+
+    @pytest.mark.parametrize("operation", ("retrieve", "verify"))
+    def test_operation(self, archived, operation):
+        """Test operations on a stored archive."""
+        assert run(archived, f"--{operation}") == 0
+
+    def test_plan(self, archived, capsys):
+        """Test planning predicts a skipped upload for unchanged databases."""
+        capsys.readouterr()
+        assert run(archived, "--plan") == 0
+        plan, = json.loads(capsys.readouterr().out)["plans"]
+        assert plan["calibration_runs"] == 1
+        assert plan["dedup_skip"] == (not plan["changed"])
+        if plan["dedup_skip"]:
+            assert plan["predicted"]["stored_bytes"] == 0